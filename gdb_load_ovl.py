@@ -8,10 +8,31 @@
 
 import gdb
 import re
+from bisect import bisect_right
+from pathlib import Path
 
-TYPE_U32 = gdb.lookup_type('u32')
+# resolved on first use, so the script can be sourced before the ELF providing `u32` is loaded
+TYPE_U32 = None
 
-# address to object-path map, used to unload entire .o files by an address
+def _as_u32(val):
+    global TYPE_U32
+    if TYPE_U32 is None:
+        TYPE_U32 = gdb.lookup_type('u32')
+    return int(val.cast(TYPE_U32))
+
+TYPE_VOIDP = gdb.lookup_type('void').pointer()
+
+# overlay type prefix of an enum name, e.g. "ACTOR" in "ACTOR_EN_KUSA"
+OVL_TYPE_PATTERN = re.compile(r'^([^_]+)')
+# overlay section line of `info files`, e.g. "\t0x80800000 - 0x80801ec0 is ..ovl_En_Kusa"
+INFO_FILE_LINE_PATTERN = re.compile(r'\s*0x([0-9a-fA-F]+) - 0x([0-9a-fA-F]+) is \.\.(\S+)')
+# overlay section in `info symbol` output, e.g. "EnKusa_SetupAction in section ..ovl_En_Kusa of zelda.elf"
+INFO_SYM_SECTION_PATTERN = re.compile(r'in section \.\.(\S+)')
+# pointer formatted with symbols, e.g. "0x80800000 <EnKusa_SetupAction+16>"
+VALUE_SYM_FMT_PATTERN = re.compile(r'0x[0-9a-fA-F]+ <([^+>]+)(?:\+\d+)?>')
+
+# address to (vram address, object-path, object name) map, used to skip loading the same overlay again
+# and to unload entire .o files by an address
 obj_address_map = {}
 
 supported_versions = [
@@ -23,88 +44,245 @@ supported_versions = [
 
 current_version = "gc-eu-mq-dbg"
 
-def get_section_address(ovl_name, section_name):
-  section_start_name = "_" + ovl_name + "Segment" + section_name + "Start"
-  # 'section_start_name' is a 'text variable' according to gdb, this can not be resolved via python directly
-  return int(gdb.execute('printf "%x", &' + section_start_name, False, True), 16)
+# build directory of `current_version`, reset by the `ver` command
+_build_root = None
+
+def _get_build_root():
+    global _build_root
+    if _build_root is None:
+        _build_root = Path("build") / current_version
+    return _build_root
+
+# overlay type prefix to overlay table symbol name
+TABLE_SYMS = {
+    "GAMESTATE": "gGameStateOverlayTable",
+    "ACTOR":     "gActorOverlayTable",
+    "EFFECT":    "gEffectSsOverlayTable",
+}
+
+# overlays without a usable enum, mapped to (table symbol name, index)
+SPECIAL_OVLS = {
+    # Pause menu does not have an enum, special case it. Index is 0 in `gKaleidoMgrOverlayTable`
+    "PAUSE":         ("gKaleidoMgrOverlayTable", 0),
+    "KALEIDO":       ("gKaleidoMgrOverlayTable", 0),
+    "KALEIDO_SCOPE": ("gKaleidoMgrOverlayTable", 0),
+    # Player's index does not correspond to his actor ID, Special case it. Index is 1 in `gKaleidoMgrOverlayTable`
+    "ACTOR_PLAYER":  ("gKaleidoMgrOverlayTable", 1),
+}
+
+# overlay table symbol name to resolved symbol, filled on first use.
+# The symbol is cached rather than its value so every read of the table still sees current memory.
+_tables = {}
+
+def _table(name):
+    sym = _tables.get(name)
+    if sym is None:
+        sym = gdb.lookup_global_symbol(name)
+        if sym is None:
+            # e.g. the script was sourced before the ELF was loaded
+            raise ValueError(f"{name} could not be found in the elf.")
+        _tables[name] = sym
+    return sym.value()
+
+def _on_new_objfile(event):
+    # overlay objects added with add-symbol-file trigger this too, only a (re)load of the main ELF invalidates
+    global TYPE_U32, _section_intervals_built
+    if event.new_objfile.filename == gdb.current_progspace().filename:
+        TYPE_U32 = None
+        # reloading the main ELF drops every objfile added with add-symbol-file
+        obj_address_map.clear()
+        _tables.clear()
+        _section_addr_cache.clear()
+        _section_intervals.clear()
+        _section_starts.clear()
+        _section_intervals_built = False
+
+# the script is sourced again on every `target remote` (see README), only connect the handler once
+if not globals().get("_EVENTS_CONNECTED", False):
+    gdb.events.new_objfile.connect(_on_new_objfile)
+    _EVENTS_CONNECTED = True
+
+# (linker script name, object file section name) of the overlay segments,
+# in the order get_section_addresses returns them. The text section has to come first.
+OVL_SECTIONS = (
+    ("Text",   ".text"),
+    ("Data",   ".data"),
+    ("RoData", ".rodata"),
+    ("Bss",    ".bss"),
+)
+
+# overlay name to segment start addresses, cleared when the main ELF is reloaded
+_section_addr_cache = {}
+
+def get_section_addresses(ovl_name):
+    addrs = _section_addr_cache.get(ovl_name)
+    if addrs is None:
+        # the segment symbols are 'text variables' (minimal symbols) according to gdb, lookup_global_symbol
+        # can not resolve them, but taking their address in an expression can. All sections are read
+        # with a single array expression: {(unsigned int)&_ovl_En_KusaSegmentTextStart, ...}
+        expr = "{" + ", ".join(f"(unsigned int)&_{ovl_name}Segment{sec}Start" for sec, _ in OVL_SECTIONS) + "}"
+        value = gdb.parse_and_eval(expr)
+        addrs = tuple(int(value[i]) for i in range(len(OVL_SECTIONS)))
+        _section_addr_cache[ovl_name] = addrs
+    return addrs
+
+def get_sym_name_from_addr(addr):
+    try:
+        block = gdb.block_for_pc(addr)
+    except RuntimeError:
+        # older gdb raises instead of returning None when no objfile covers the address
+        block = None
+
+    # innermost block may be a lexical block, walk up to the enclosing function
+    while block is not None and block.function is None:
+        block = block.superblock
+    if block is not None:
+        return block.function.name
+
+    # no debug info covers the address, fall back to the minimal symbol gdb prints for the pointer
+    match = VALUE_SYM_FMT_PATTERN.fullmatch(gdb.Value(addr).cast(TYPE_VOIDP).format_string(raw=True, symbols=True))
+    if match is None:
+        raise ValueError(f"No symbol found at {addr:#x}")
+    return match.group(1)
+
+# sorted (start, end, name) ranges of the main ELF's overlay sections, and their starts for bisecting.
+# Built from `info files` on first use, cleared when the main ELF is reloaded.
+_section_intervals = []
+_section_starts = []
+# tracked separately from the lists, an ELF without overlay sections must not be scanned on every call
+_section_intervals_built = False
+
+def _load_section_intervals():
+    global _section_intervals_built
+    intervals = []
+    for line in gdb.execute("info files", False, True).splitlines():
+        # lines of other objfiles end in "in <file>" and do not fullmatch
+        match = INFO_FILE_LINE_PATTERN.fullmatch(line)
+        if match is not None:
+            start, end = int(match.group(1), 16), int(match.group(2), 16)
+            if start < end:
+                intervals.append((start, end, match.group(3)))
+    intervals.sort()
+    _section_intervals[:] = intervals
+    _section_starts[:] = [start for start, _, _ in intervals]
+    _section_intervals_built = True
+
+def get_sym_section(addr):
+    if not _section_intervals_built:
+        _load_section_intervals()
+    i = bisect_right(_section_starts, addr) - 1
+    if i >= 0 and addr < _section_intervals[i][1]:
+        return _section_intervals[i][2]
+
+    # not in a known overlay section, ask gdb directly
+    # returns: "EnKusa_SetupAction in section ..ovl_En_Kusa of zelda_ocarina_mq_dbg.elf"
+    # the python API does not expose ELF section names, so this goes through `info symbol`
+    info_sym = gdb.execute(f"info symbol {addr}", False, True)
+    match = INFO_SYM_SECTION_PATTERN.search(info_sym)
+    if match is None:
+        raise ValueError(f"No overlay section found at {addr:#x}")
+    return match.group(1)
+
+def get_source_filename(addr):
+    # the line table reaches the symtab directly, without a name based symbol lookup
+    symtab = gdb.find_pc_line(addr).symtab
+    if symtab is not None:
+        return symtab.filename
+
+    # no line info for the address, go through the symbol of the function there
+    name = get_sym_name_from_addr(addr)
+    sym = gdb.lookup_symbol(name)[0]
+    if sym is None or sym.symtab is None:
+        raise ValueError(f"No debug info found for {name}")
+    return sym.symtab.filename
 
 def AddOverlaySymbols(overlay_table, index):
-    alloc_address = int(overlay_table[index]["loadedRamAddr"].cast(TYPE_U32))
+    # read the whole entry in one go, the fields below then come from its contents
+    # instead of a separate target memory read each
+    entry = overlay_table[index]
+    entry.fetch_lazy()
+
+    alloc_address = _as_u32(entry["loadedRamAddr"])
 
     if alloc_address == 0:
         print("ERROR: Requested overlay is not currently loaded")
         return
     
-    vram_address = int(overlay_table[index]["vramStart"].cast(TYPE_U32))
-    
-    # get first symbol-name starting from vramStart (usually the first function in the overlay)
-    target_func_name = gdb.execute(f"info symbol {vram_address}", False, True).partition(' ')[0].rstrip()
+    vram_address = _as_u32(entry["vramStart"])
+
+    # same overlay still at the same address, its symbols are already there
+    # unless they were dropped with remove-symbol-file since
+    loaded = obj_address_map.get(alloc_address)
+    if loaded is not None and loaded[0] == vram_address:
+        try:
+            gdb.lookup_objfile(loaded[1])
+            print(f"Overlay {loaded[2]} is already loaded.")
+            return
+        except ValueError:
+            del obj_address_map[alloc_address]
 
-    # get section in main ELF (returns: "EnKusa_SetupAction in section ..ovl_En_Kusa of zelda_ocarina_mq_dbg.elf")
-    ovl_sec_name = gdb.execute("info sym " + target_func_name, False, True)
-    # extract section name (@TODO: check if there is a direct API for this)
-    ovl_sec_name = ovl_sec_name.partition('section ..')[2].partition(" ")[0].rstrip()
+    # get the source file of the code at vramStart (usually the first function in the overlay)
+    try:
+        target_filename = get_source_filename(vram_address)
+        ovl_sec_name = get_sym_section(vram_address)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        return
 
-    ovl_address_text   = get_section_address(ovl_sec_name, "Text")
-    ovl_address_data   = get_section_address(ovl_sec_name, "Data")
-    ovl_address_rodata = get_section_address(ovl_sec_name, "RoData")
-    ovl_address_bss    = get_section_address(ovl_sec_name, "Bss")
+    ovl_addresses = get_section_addresses(ovl_sec_name)
+    ovl_address_text = ovl_addresses[0]
 
-    ovl_offset_text   = alloc_address
-    ovl_offset_data   = alloc_address + (ovl_address_data   - ovl_address_text)
-    ovl_offset_rodata = alloc_address + (ovl_address_rodata - ovl_address_text)
-    ovl_offset_bss    = alloc_address + (ovl_address_bss    - ovl_address_text)
+    # each section keeps its offset from .text when relocated to the allocated address
+    section_args = ""
+    for (_, sec_name), ovl_address in zip(OVL_SECTIONS, ovl_addresses):
+        section_args += f" -s {sec_name} {alloc_address + (ovl_address - ovl_address_text):#x}"
 
     # get full object-file path that contains the first symbol
-    target_filename = gdb.lookup_symbol(target_func_name)[0].symtab.filename
-    obj_name = f"build/{current_version}/{target_filename[:-2]}.o"
-
-    pattern = r'[^/]*$'
-    matches = re.findall(pattern, obj_name)
-    ovl_name = matches[0]
-
-    obj_address_map[hex(alloc_address)] = obj_name
-    print("Reading " + ovl_name[:-2] + "...")
-
-    gdb.execute("add-symbol-file -readnow " + obj_name +
-      " -o 0xFF000000" +
-      " -s .text "   + hex(ovl_offset_text)   +
-      " -s .data "   + hex(ovl_offset_data)   +
-      " -s .rodata " + hex(ovl_offset_rodata) +
-      " -s .bss "    + hex(ovl_offset_bss),
+    obj_path = _get_build_root() / (target_filename[:-2] + ".o")
+
+    obj_file = str(obj_path)
+    obj_stem = obj_path.stem
+
+    print("Reading " + obj_stem + "...")
+
+    readnow = " -readnow" if readnow_param.value else ""
+    gdb.execute("add-symbol-file" + readnow + " " + obj_file +
+      " -o 0xFF000000" + section_args,
       False, True)
-    
+
+    # only record the overlay once gdb actually has its symbols, so a failed load can be retried
+    obj_address_map[alloc_address] = (vram_address, obj_file, obj_stem)
     print("Complete.")
 
 def process_ovl(name):
     name = name.upper()
 
-    if name == "PAUSE" or name == "KALEIDO" or name == "KALEIDO_SCOPE":
-        # Pause menu does not have an enum, special case it. Index is 0 in `gKaleidoMgrOverlayTable`
-        table = gdb.lookup_global_symbol("gKaleidoMgrOverlayTable").value()
-        AddOverlaySymbols(table, 0)
-    elif name == "ACTOR_PLAYER":
-        # Player's index does not correspond to his actor ID, Special case it. Index is 1 in `gKaleidoMgrOverlayTable`
-        table = gdb.lookup_global_symbol("gKaleidoMgrOverlayTable").value()
-        AddOverlaySymbols(table, 1)
+    special = SPECIAL_OVLS.get(name)
+    if special is not None:
+        try:
+            table = _table(special[0])
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            return
+
+        AddOverlaySymbols(table, special[1])
     else:
-        pattern = r'^([^_]+)'
-        matches = re.findall(pattern, name)
-        ovl_type = matches[0]
-
-        if ovl_type == "GAMESTATE":
-            table = gdb.lookup_global_symbol("gGameStateOverlayTable").value()
-        elif ovl_type == "ACTOR":
-            table = gdb.lookup_global_symbol("gActorOverlayTable").value()
-        elif ovl_type == "EFFECT":
-            table = gdb.lookup_global_symbol("gEffectSsOverlayTable").value()
-        else:
+        match = OVL_TYPE_PATTERN.match(name)
+        ovl_type = match.group(1) if match is not None else None
+
+        if ovl_type not in TABLE_SYMS:
             print("ERROR: Type of enum provided is not supported")
             return
-        
+
+        try:
+            table = _table(TABLE_SYMS[ovl_type])
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            return
+
         # try to get the index from the elf via gdb
         try:
-            index = gdb.lookup_symbol(name)[0].value().cast(TYPE_U32)
+            index = _as_u32(gdb.lookup_symbol(name)[0].value())
         except:
             print("ERROR: Provided enum value could not be found in the elf.")
             return
@@ -124,14 +302,30 @@ class ChangeVerCmd(gdb.Command):
         super().__init__("ver", gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
 
     def invoke(self, arg, from_tty):
+        global current_version, _build_root
         arg = arg.lower()
 
         if arg in supported_versions:
             current_version = arg
+            _build_root = None
+            # loaded objects came from the previous version's build directory
+            obj_address_map.clear()
             print(f"Version changed to {arg}")
         else:
             print(f"ERROR: \"{arg}\" is not a supported game version. Please try again.")
 
+class ReadNowParam(gdb.Parameter):
+    """Controls whether overlay symbols are fully expanded when loaded (add-symbol-file -readnow)."""
+
+    set_doc = "Set whether overlay symbols are fully expanded when loaded."
+    show_doc = "Show whether overlay symbols are fully expanded when loaded."
+
+    def __init__(self):
+        super().__init__("ovl-readnow", gdb.COMMAND_DATA, gdb.PARAM_BOOLEAN)
+
 LoadOvlCmd()
 ChangeVerCmd()
+# like the objfile handler, create the parameter only once so sourcing the script again keeps its setting
+if "readnow_param" not in globals():
+    readnow_param = ReadNowParam()
 process_ovl("ACTOR_PLAYER")